@@ -17,18 +17,24 @@ More info: https://github.com/mollydesjardin/aozora-lambda/
 
 """
 
+import codecs
+import html
+import io
 import logging
 import os
 import re
 import sys
-import uuid
+import threading
 import warnings
-from typing import Any, Match
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
 from urllib.parse import unquote_plus
 
 import boto3
+import botocore.config
 import botocore.exceptions
-import MeCab
+import fugashi
+from boto3.s3.transfer import TransferConfig
 from bs4 import BeautifulSoup as bs
 from bs4 import XMLParsedAsHTMLWarning
 
@@ -36,9 +42,12 @@ logger = logging.getLogger()
 logger.setLevel("INFO")
 DICT_DIR = os.environ["EFS_DICT"]
 
-def create_tagger(dict_config: str) -> MeCab.Tagger:
+def create_tagger(dict_config: str) -> fugashi.GenericTagger:
     try:
-        tagger = MeCab.Tagger(f"-r {os.devnull!s} -d {dict_config!s} -Owakati")
+        # fugashi's Cython wrapper has lower call overhead than the SWIG
+        # MeCab binding, with the same MeCab options and wakati output
+        tagger = fugashi.GenericTagger(f"-r {os.devnull!s} -d {dict_config!s} "
+                                       f"-Owakati")
         logger.info("Mecab Tagger created")
         return tagger
     except RuntimeError as e:
@@ -58,86 +67,117 @@ def create_tagger(dict_config: str) -> MeCab.Tagger:
         logger.critical(e, stack_info=True)
         sys.exit(1)
 
-# Create MeCab tagger to reuse for all texts
+# Create MeCab tagger to reuse for all texts. A Tagger isn't safe to use from
+# several threads at once, so parsing is serialized with a lock
 tagger = create_tagger(DICT_DIR)
+tagger_lock = threading.Lock()
+# Maximum number of files from one event to process concurrently
+MAX_WORKERS = 8
+# Upload larger outputs as 1 MB parts, several at a time
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=1024 * 1024,
+                                 multipart_chunksize=1024 * 1024,
+                                 max_concurrency=8, use_threads=True)
+# Create S3 client to reuse for all files and warm invocations, along with its
+# connection pool. Clients are safe to share between threads. Size the pool
+# so each worker thread's transfer threads can all hold a connection
+s3_client = boto3.client("s3", config=botocore.config.Config(
+    max_pool_connections=MAX_WORKERS * TRANSFER_CONFIG.max_concurrency))
 # Suppress Beautiful Soup warnings (false positives)
 warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
 
 
-ruby = {"start": "<ruby><rb>", "end": "</rb>"}
-ruby_old = {"start": "<!R>", "end": "（"}
-ruby_pattern = "<ruby><rb>.*?</rb><rp>.*?</ruby>"
-ruby_pattern_old = "<!R>.*?（.*?）"
-
-def strip_ruby(text: str) -> str:
-    """Strip ruby annotations and markup from Aozora HTML files.
+# Look up the Shift-JIS decoder once, instead of on every decode
+SJIS_DECODE = codecs.getdecoder("shift_jis")
+# Ruby markup patterns, compiled once at import time. Group 1 captures the
+# base phrase, which is all that is kept from each match. <br /> is removed in
+# the same pass (group 1 is empty) to avoid excessive line breaks in output,
+# and so is \r before \n, since input is decoded from raw bytes
+RUBY_START = b"<ruby><rb>"
+RUBY_OLD_START = b"<!R>"
+BR_RE = re.compile(rb"<br />|\r(?=\n)")
+RUBY_RE = re.compile(rb"<br />|\r(?=\n)|<ruby><rb>(.*?)</rb><rp>.*?</ruby>")
+RUBY_OLD_RE = re.compile(r"<br />|\r(?=\n)|<!R>(.*?)（.*?）")
+# Standard Aozora HTML has exactly one main_text div, directly followed by
+# bibliographical information. Nested divs only close inside main_text, so
+# this end marker finds the right </div>
+MAIN_TEXT_START = '<div class="main_text">'
+MAIN_TEXT_RE = re.compile(r'<div class="main_text">(.*?)</div>\s*'
+                          r'<div class="bibliographical_information">',
+                          re.DOTALL)
+# Older files without main_text use all of <body> instead. Parsers move any
+# text after </body> back into <body>, so only use the regex when nothing but
+# </html> follows
+BODY_RE = re.compile(r"<body\b[^>]*>(.*)</body>", re.DOTALL | re.IGNORECASE)
+BODY_END_RE = re.compile(r"\s*(?:</html>\s*)?", re.IGNORECASE)
+# Leave out script and style contents and comments, which aren't part of the
+# work. This is intentional: html5lib's .text used to keep script and style
+SKIP_RE = re.compile(r"<(script|style)\b[^>]*>.*?</\1>|<!--.*?-->",
+                     re.DOTALL | re.IGNORECASE)
+# As in the HTML tokenizer, a tag only starts with < followed by a letter,
+# / and a letter, ! or ?. Any other bare < is text and must be kept
+TAG_RE = re.compile(r"</?[A-Za-z][^>]*>|<[!?][^>]*>")
+# lxml is much faster than html5lib, but html5lib recovers some malformed
+# HTML better and is only tried if lxml finds no work content
+HTML_PARSERS = ("lxml", "html5lib")
+# lxml leaves text after </body> outside of <body>, unlike html5lib
+NON_BLANK_RE = re.compile(r"\S")
+
+def strip_ruby(data: bytes) -> str:
+    """Strip ruby annotations, markup, and <br /> tags from Aozora HTML files.
 
     Parameters
     -------
-    text : str
-        Text with Aozora HTML and ruby markup
+    data : bytes
+        Shift-JIS encoded file contents with Aozora HTML and ruby markup
 
     Returns
     -------
     str
-        Original input text (including ruby-glossed base phrases inline),
-        stripped of ruby markup and gloss content
+        Decoded input text (including ruby-glossed base phrases inline),
+        stripped of ruby markup, gloss content, and <br /> tags
 
     """
 
-    if ruby["start"] in text:
-        return re.sub(ruby_pattern, ruby_replace, text)
-    elif ruby_old["start"] in text:
-        return re.sub(ruby_pattern_old, ruby_replace_old, text)
-    # No ruby markup found, return input as-is
+    # It's safe to substitute standard ruby markup before decoding because
+    # every bytes pattern alternative starts with < (or is \r before \n), and
+    # none of those can be a Shift-JIS trail byte, so matches always begin on
+    # a character boundary. Printable ASCII letters CAN be trail bytes, so
+    # never add a bytes pattern that starts with one
+    if RUBY_START in data:
+        return SJIS_DECODE(RUBY_RE.sub(rb"\1", data), "ignore")[0]
+    # Old ruby markup ends with full-width parentheses, so decode first
+    elif RUBY_OLD_START in data:
+        text = SJIS_DECODE(data, "ignore")[0]
+        return RUBY_OLD_RE.sub(r"\1", text)
+    # No ruby markup found, only remove <br />
     else:
-        return text
-
-
-def ruby_replace(matchobj: Match) -> str:
-    """Extract base phrase from ruby pattern matches in standard Aozora files.
-
-    Parameters
-    -------
-    matchobj : Match
-        Individual ruby pattern regex match from standard Aozora HTML
-
-    Returns
-    -------
-    str
-        Base phrase only, stripped of markup and glosses
-
-    """
-
-    return matchobj.group(0).lstrip(ruby["start"]).split(ruby["end"])[0]
+        return SJIS_DECODE(BR_RE.sub(b"", data), "ignore")[0]
 
 
-def ruby_replace_old(matchobj: Match) -> str:
-    """Extract base phrase from ruby pattern matches in oldest Aozora files.
+def strip_tags(markup: str) -> str:
+    """Return plain text from an HTML fragment, without building a parse tree
 
     Parameters
     -------
-    matchobj : Match
-        Individual ruby pattern regex match from non-standard Aozora HTML
+    markup : str
+        HTML fragment, with ruby markup already stripped
 
     Returns
     -------
     str
-        Base phrase only, stripped of markup and glosses
-
+        Fragment text, stripped of tags and with entities unescaped
     """
 
-    return matchobj.group(0).lstrip(ruby_old["start"]).split(ruby_old[
-                                                                 "end"])[0]
+    return html.unescape(TAG_RE.sub("", SKIP_RE.sub("", markup)))
 
 
-def extract_work(html_text: str) -> str:
+def extract_work(html_data: bytes) -> str:
     """Return work (sakuhin) content, stripped of HTML markup and metadata
 
     Parameters
     -------
-    html_text : str
-        Aozora HTML file contents
+    html_data : bytes
+        Aozora HTML file contents, Shift-JIS encoded
 
     Returns
     -------
@@ -146,19 +186,44 @@ def extract_work(html_text: str) -> str:
 
     """
 
-    # Clean up <br /> to avoid excessive line breaks in final output
-    html_text = html_text.replace("<br />", "")
-    html_text = strip_ruby(html_text)
+    html_text = strip_ruby(html_data)
+    # For standard files, slice out main_text and strip the remaining tags
+    # without building a parse tree
+    main_text = MAIN_TEXT_RE.search(html_text)
+    if main_text and html_text.count(MAIN_TEXT_START) == 1:
+        work_text = strip_tags(main_text.group(1))
+        if work_text:
+            return work_text
+    # For older files, do the same with <body>
+    elif "main_text" not in html_text:
+        body = BODY_RE.search(html_text)
+        if body and BODY_END_RE.fullmatch(html_text, body.end()):
+            work_text = strip_tags(body.group(1))
+            if work_text:
+                return work_text
+    # Otherwise fall back to Beautiful Soup
     try:
-        soup = bs(html_text, "html5lib").select(".main_text")
-        # Aozora standard HTML contains exactly ONE div with "main_text" class
-        if len(soup) == 1:
-            return soup[0].text
-        # For older files, return markup-stripped text from <body>
-        elif len(soup) == 0:
-            soup = bs(html_text, "html5lib").find("body")
-            if soup:
-                return soup.text
+        for parser in HTML_PARSERS:
+            soup = bs(html_text, parser)
+            main_text = soup.find_all("div", class_="main_text", limit=2)
+            # Aozora standard HTML contains exactly ONE div with "main_text"
+            # class
+            if len(main_text) == 1:
+                work_text = main_text[0].get_text()
+            # For older files, return markup-stripped text from <body>,
+            # reusing the same parse tree
+            elif len(main_text) == 0:
+                body = soup.body
+                # Leave files with text after <body> for html5lib
+                if body and not any(NON_BLANK_RE.search(sibling.get_text())
+                                    for sibling in body.next_siblings):
+                    work_text = body.get_text()
+                else:
+                    work_text = ""
+            else:
+                work_text = ""
+            if work_text:
+                return work_text
         # Do not process if unexpected structure
         return ""
     except(AttributeError, KeyError, UnicodeEncodeError) as e:
@@ -186,10 +251,15 @@ def mecab_parse(text: str) -> str:
         Input text with whitespace inserted between words
     """
 
+    # MeCab treats line breaks as whitespace between words, so each line must
+    # be parsed separately to keep them. Blank lines would parse to an empty
+    # string anyway, so skip calling MeCab for those
     text_lines = text.split("\n")
     try:
-        parsed_text = "\n".join([tagger.parse(line).strip() for line in
-                             text_lines]).strip()
+        with tagger_lock:
+            parsed_text = "\n".join([tagger.parse(line).strip()
+                                     if line and not line.isspace() else ""
+                                     for line in text_lines]).strip()
         return parsed_text
     # return an empty string if MeCab or other error
     except RuntimeError as e:
@@ -202,36 +272,34 @@ def mecab_parse(text: str) -> str:
         return ""
 
 
-def convert_html_txt(input_path: str, output_path: str) -> bool:
+def convert_html_txt(html_data: bytes) -> str:
     """Transform Aozora works to word-tokenized, plain-text versions from HTML.
 
     Parameters
     -------
-    input_path : str
-        Path of input Aozora .html file
-    output_path : str
-        Path to write converted result as .txt file
+    html_data : bytes
+        Contents of input Aozora .html file
+
+    Returns
+    -------
+    str
+        Converted result to save as .txt file, or empty string on failure
     """
 
-    with open(input_path, mode="r", encoding="Shift-JIS",
-              errors="ignore") as html_file:
-        text = html_file.read()
-        work_only = extract_work(text)
-        if work_only:
-            parsed_text = mecab_parse(work_only)
-            if parsed_text:
-                with open(output_path, mode="w", encoding="utf-8") as txt_file:
-                    txt_file.write(parsed_text)
-                return True
-            else:
-                logger.error("MeCab parsing failed, returning False to "
-                             "handler without saving output")
-                return False
+    work_only = extract_work(html_data)
+    if work_only:
+        parsed_text = mecab_parse(work_only)
+        if parsed_text:
+            return parsed_text
         else:
-            logger.error("Beautiful Soup couldn't process unexpected file "
-                         "structure. Returning False to handler without "
-                         "parsing or saving output")
-            return False
+            logger.error("MeCab parsing failed, returning to handler "
+                         "without saving output")
+            return ""
+    else:
+        logger.error("Beautiful Soup couldn't process unexpected file "
+                     "structure. Returning to handler without "
+                     "parsing or saving output")
+        return ""
 
 
 def generate_output_key(original_key: str) -> str:
@@ -249,12 +317,64 @@ def generate_output_key(original_key: str) -> str:
     """
 
     if original_key:
+        filename = original_key.removesuffix(".html")
         return f"{filename!s}_tokenized.txt"
     else:
         return ""
 
 
-def check_output(s3_client, output_bucket: str, output_key: str) -> bool:
+def list_outputs(s3_client, output_bucket: str,
+                 output_keys: list[str]) -> set[str] | None:
+    """Find which output keys already exist, with one listing of the bucket
+
+    Parameters
+    -------
+    s3_client
+        Open S3 client to use for listing objects
+    output_bucket : str
+        Output S3 bucket name
+    output_keys : list[str]
+        Output key names ending in .txt, all in output_bucket
+
+    Returns
+    -------
+    set[str] or None
+        Keys from output_keys that already exist in output_bucket
+        None if the keys share no prefix, or the bucket couldn't be listed
+    """
+
+    # Only list under the longest prefix shared by all keys. Without one, the
+    # whole bucket would be listed, so check each key individually instead
+    prefix = os.path.commonprefix(output_keys)
+    if not prefix:
+        return None
+    wanted_keys = set(output_keys)
+    first_key = min(wanted_keys)
+    last_key = max(wanted_keys)
+    existing_keys = set()
+    try:
+        paginator = s3_client.get_paginator("list_objects_v2")
+        # S3 lists keys in sorted order, so start just before the first wanted
+        # key and stop once past the last one
+        for page in paginator.paginate(Bucket=output_bucket, Prefix=prefix,
+                                       StartAfter=first_key[:-1]):
+            contents = page.get("Contents", [])
+            existing_keys.update(obj["Key"] for obj in contents
+                                 if obj["Key"] in wanted_keys)
+            if contents and contents[-1]["Key"] >= last_key:
+                break
+        return existing_keys
+    except botocore.exceptions.ClientError as e:
+        logger.warning(f"Couldn't list existing output in bucket "
+                       f"{output_bucket!s}, checking each file individually")
+        logger.warning(e.response["Error"]["Code"])
+    except Exception as e:
+        logger.error(e, stack_info=True)
+    return None
+
+
+def check_output(s3_client, output_bucket: str, output_key: str,
+                 existing_keys: set[str] | None = None) -> bool:
     """Check whether it is OK to write output to the destination bucket and key
 
     Parameters
@@ -265,6 +385,9 @@ def check_output(s3_client, output_bucket: str, output_key: str) -> bool:
         Output S3 bucket name
     output_key : str
         Output key name ending in .txt
+    existing_keys : set[str] or None
+        Existing keys already found by `list_outputs`, if the bucket was
+        listed. Otherwise, check the key individually with `head_object`
 
     Returns
     -------
@@ -273,14 +396,21 @@ def check_output(s3_client, output_bucket: str, output_key: str) -> bool:
         False if the output key exists already, or any other error
     """
 
+    if existing_keys is not None:
+        if output_key in existing_keys:
+            logger.warning(f"Found existing output named {output_key!s}, "
+                           f"skipping further processing")
+            return False
+        return True
     try:
-        s3_client.get_object(Bucket=output_bucket, Key=output_key)
+        s3_client.head_object(Bucket=output_bucket, Key=output_key)
         logger.warning(f"Found existing output named {output_key!s}, "
                        f"skipping further processing")
         return False
     except botocore.exceptions.ClientError as e:
         error_code = e.response["Error"]["Code"]
-        if error_code == "NoSuchKey":
+        # head_object has no response body, so a missing key is only a 404
+        if error_code == "404":
             return True
         else:
             logger.error(f"Skipped processing because of error with S3 "
@@ -291,41 +421,104 @@ def check_output(s3_client, output_bucket: str, output_key: str) -> bool:
     return False
 
 
-def lambda_handler(event: dict, context: Any) -> None:
-    s3_client = boto3.client("s3")
-    success_count = 0
+def process_file(s3_client, bucket: str, key: str, output_bucket: str,
+                 output_key: str, existing_keys: set[str] | None) -> bool:
+    """Convert one file from an S3 event and save output to the output bucket
+
+    Parameters
+    -------
+    s3_client
+        Open S3 client, shared by all worker threads and invocations
+    bucket : str
+        Input S3 bucket name
+    key : str
+        Input key name ending in .html
+    output_bucket : str
+        Output S3 bucket name
+    output_key : str
+        Output key name ending in .txt
+    existing_keys : set[str] or None
+        Existing keys found by `list_outputs`, passed on to `check_output`
 
+    Returns
+    -------
+    bool
+        True if output was saved, False if skipped or failed
+    """
+
+    # Only proceed if output does NOT already exist and output_key was
+    # successfully created
+    if not (output_key and check_output(s3_client, output_bucket, output_key,
+                                        existing_keys)):
+        return False
+
+    # Files are small enough to transfer in memory, without /tmp. Reading
+    # the whole get_object body returns one bytes object of the known
+    # content length, rather than growing a buffer chunk by chunk
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        parsed_text = convert_html_txt(response["Body"].read())
+        if parsed_text:
+            s3_client.upload_fileobj(io.BytesIO(parsed_text.encode("utf-8")),
+                                     output_bucket, output_key,
+                                     Config=TRANSFER_CONFIG)
+            logger.info(f"Processed {key!s} and saved output as"
+                        f" {output_key!s} in {output_bucket!s}")
+            return True
+        else:
+            logger.error(f"Failed to process {key!s}, didn't save output")
+    except botocore.exceptions.ClientError as s3_error:
+        logger.error(f"Couldn't process {key!s} due to S3 problem")
+        logger.error(s3_error)
+    except Exception as e:
+        logger.error(f"Couldn't process {key!s}")
+        logger.error(e, stack_info=True)
+    return False
+
+
+def lambda_handler(event: dict, context: Any) -> None:
     # Iterate over the S3 event object and get all event file keys
     # Assume the S3 trigger is set to only process .html suffix files
+    files = []
+    batch_output_keys = {}
+    # Records in one event almost always share a bucket, so only build each
+    # output bucket name once
+    output_buckets = {}
     for record in event["Records"]:
         # Remove URL-encoded characters from S3 object name
         key = unquote_plus(record["s3"]["object"]["key"])
 
         output_key = generate_output_key(key)
         bucket = record["s3"]["bucket"]["name"]
-        output_bucket = f"{bucket!s}-converted"
-
-        # Only proceed if output does NOT already exist and output_key was
-        # successfully created
-        if output_key and check_output(s3_client, output_bucket, output_key):
-            # Create working paths in the Lambda tmp directory
-            download_path = f"/tmp/{uuid.uuid4()}.html"
-            upload_path = f"/tmp/tokenized-{uuid.uuid4()}.txt"
-            try:
-                s3_client.download_file(bucket, key, download_path)
-                if convert_html_txt(download_path, upload_path):
-                    s3_client.upload_file(upload_path, output_bucket, output_key)
-                    logger.info(f"Processed {key!s} and saved output as"
-                                f" {output_key!s} in {output_bucket!s}")
-                    success_count += 1
-                else:
-                    logger.error(f"Failed to process {key!s}, didn't save output")
-            except botocore.exceptions.ClientError as s3_error:
-                logger.error(f"Couldn't process {key!s} due to S3 problem")
-                logger.error(s3_error)
-            except Exception as e:
-                logger.error(f"Couldn't process {key!s}")
-                logger.error(e, stack_info=True)
+        if bucket not in output_buckets:
+            output_buckets[bucket] = f"{bucket!s}-converted"
+        output_bucket = output_buckets[bucket]
+        files.append((bucket, key, output_bucket, output_key))
+        if output_key:
+            batch_output_keys.setdefault(output_bucket, []).append(output_key)
+
+    # List each output bucket once for events with several files. A single
+    # file is checked just as cheaply on its own
+    existing_outputs = {
+        output_bucket: list_outputs(s3_client, output_bucket, output_keys)
+        for output_bucket, output_keys in batch_output_keys.items()
+        if len(output_keys) > 1
+    }
+
+    def process(file: tuple[str, str, str, str]) -> bool:
+        return process_file(s3_client, *file, existing_outputs.get(file[2]))
+
+    # S3 events usually contain one file, so skip thread pool overhead then.
+    # Otherwise, each file is mostly waiting on S3, so overlap files in
+    # worker threads
+    if len(files) <= 1:
+        results = [process(file) for file in files]
+    else:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS,
+                                                len(files))) as executor:
+            results = list(executor.map(process, files))
+    success_count = sum(results)
+
     if success_count >= 1:
         logger.info(f"Finished trying to process {success_count!s} files")
     else: